@@ -1,20 +1,21 @@
-from groq import Groq
 import streamlit as st
-from dotenv import load_dotenv
+from markdown_it import MarkdownIt
 import os
+import re
 import shelve
+import sqlite3
 import time
 import logging
-from typing import Dict, List, Optional
-import os 
-os.system("pip install groq")
+import uuid
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    from groq import Groq
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("phoenix-ai")
 
-# Load environment variables
-load_dotenv()
-
 # Constants
 DEFAULT_MODEL = "llama3-70b-8192"
 MODELS = {
@@ -23,13 +24,36 @@ MODELS = {
     "Mixtral 8x7B": "mixtral-8x7b-32768",
     "Claude 3 Opus": "claude-3-opus-20240229"
 }
-DATA_STORE = "chat_history"
+MODEL_NAMES = tuple(MODELS.keys())
+MODEL_ID_TO_NAME = {model_id: name for name, model_id in MODELS.items()}
+MODEL_NAME_TO_IDX = {name: i for i, name in enumerate(MODEL_NAMES)}
+DATA_STORE = "chat_history.sqlite3"
+LEGACY_DATA_STORE = "chat_history"  # shelve store used before the move to SQLite
+LEGACY_DATA_STORE_FILES = ("", ".db", ".dat")  # suffixes the dbm backends add to it
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+)
+MAX_CONTEXT_TOKENS = 6000  # rough budget for history sent with each request
+MESSAGE_TOKEN_OVERHEAD = 4  # role and framing tokens each message costs on top of its content
+MARKDOWN_CACHE_ENTRIES = 2000
+STREAM_FLUSH_INTERVAL = 0.05  # seconds between UI updates while streaming
+STREAM_FLUSH_CHARS = 64  # flush early once this many characters are buffered
+
+# Fonts are linked rather than @import-ed so the browser can open both connections up front
+FONT_LINKS = (
+    '<link rel="preconnect" href="https://fonts.googleapis.com">'
+    '<link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>'
+    '<link rel="stylesheet" href="https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600&display=swap">'
+)
 
 # Custom CSS for professional dark theme
 CUSTOM_CSS = """
 <style>
-@import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600&display=swap');
-
 * {
     font-family: 'Inter', sans-serif !important;
 }
@@ -66,7 +90,8 @@ CUSTOM_CSS = """
     box-shadow: 0 2px 8px rgba(0,0,0,0.15);
 }
 
-[data-testid="stChatMessageUser"] {
+[data-testid="stChatMessageUser"],
+.stChatMessage.user {
     background: #1A1A1A;
     margin-left: auto;
     margin-right: 0;
@@ -74,7 +99,8 @@ CUSTOM_CSS = """
     border: 1px solid #222222;
 }
 
-[data-testid="stChatMessageAssistant"] {
+[data-testid="stChatMessageAssistant"],
+.stChatMessage.assistant {
     background: #111111;
     margin-right: auto;
     margin-left: 0;
@@ -156,6 +182,161 @@ button {
 </style>
 """
 
+# Runs in the app document (no iframe); the previous keydown handler is removed so reruns don't stack listeners
+CUSTOM_JS = """
+<script>
+(() => {
+    const container = document.querySelector('[data-testid="stAppViewContainer"]');
+    if (container) {
+        container.scrollTop = container.scrollHeight;
+    }
+
+    // Add keyboard shortcut (Ctrl+Enter) for sending messages
+    if (window.__phoenix_kd) {
+        document.removeEventListener('keydown', window.__phoenix_kd);
+    }
+    window.__phoenix_kd = function(e) {
+        if (e.ctrlKey && e.key === 'Enter') {
+            const chatInput = document.querySelector('.stChatInput textarea');
+            const sendButton = document.querySelector('.stChatInput button');
+            if (chatInput && chatInput.value.trim() && sendButton) {
+                sendButton.click();
+            }
+        }
+    };
+    document.addEventListener('keydown', window.__phoenix_kd);
+})();
+</script>
+"""
+
+
+# Raw HTML in message content is escaped, since rendered output is shown with unsafe_allow_html
+MARKDOWN = MarkdownIt("commonmark", {"html": False, "breaks": True}).enable("table").enable("strikethrough")
+
+
+def make_message(role: str, content: str, msg_id: Optional[str] = None) -> Dict:
+    """Build a chat message with an immutable id used as its render cache key"""
+    return {"id": msg_id or uuid.uuid4().hex, "role": role, "content": content}
+
+
+@st.cache_data(max_entries=MARKDOWN_CACHE_ENTRIES, show_spinner=False)
+def render_markdown(msg_id: str, _content: str) -> str:
+    """Render a stored message to HTML; keyed by id only since message content never changes"""
+    return MARKDOWN.render(_content)
+
+
+def compile_css(css: str) -> str:
+    """Strip comments and whitespace from a CSS block"""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    return re.sub(r"\s*([{};,>])\s*", r"\1", css).strip()
+
+
+# Emitted on every rerun (Streamlit drops elements a rerun doesn't re-emit), so it is minified once at import
+COMPILED_CSS = FONT_LINKS + compile_css(CUSTOM_CSS)
+
+
+def message_html(msg: Dict) -> str:
+    """Wrap a message's cached HTML in a chat bubble styled like st.chat_message"""
+    return f'<div class="stChatMessage {msg["role"]}">{render_markdown(msg["id"], msg["content"])}</div>'
+
+
+def estimate_tokens(msg: Dict) -> int:
+    """Rough token count: ~4 characters per token, rounded up, plus per-message overhead"""
+    return -(-len(msg["content"]) // 4) + MESSAGE_TOKEN_OVERHEAD
+
+
+def trim_context(messages: List[Dict]) -> List[Dict]:
+    """Keep the most recent messages that fit in MAX_CONTEXT_TOKENS"""
+    system = messages[:1] if messages and messages[0]["role"] == "system" else []
+    budget = MAX_CONTEXT_TOKENS - sum(estimate_tokens(msg) for msg in system)
+    start = len(messages)
+    while start > len(system):
+        budget -= estimate_tokens(messages[start - 1])
+        # Always send the latest message, even if it alone exceeds the budget
+        if budget < 0 and start < len(messages):
+            break
+        start -= 1
+    return system + messages[start:]
+
+
+def has_legacy_store() -> bool:
+    """Whether a shelve store from before the move to SQLite is on disk"""
+    return any(os.path.exists(LEGACY_DATA_STORE + ext) for ext in LEGACY_DATA_STORE_FILES)
+
+
+def legacy_import_pending(db: sqlite3.Connection) -> bool:
+    """Whether a legacy store exists that hasn't been imported successfully yet"""
+    return db.execute("PRAGMA user_version").fetchone()[0] < 1 and has_legacy_store()
+
+
+def import_legacy_store(db: sqlite3.Connection):
+    """Copy conversations from the old shelve store into SQLite, once per database"""
+    if db.execute("PRAGMA user_version").fetchone()[0] >= 1:
+        return
+    conversations = {}
+    if has_legacy_store():
+        try:
+            with shelve.open(LEGACY_DATA_STORE, flag="r") as legacy:
+                conversations = legacy.get("conversations", {})
+        except Exception as e:
+            # Leave the store unversioned so the next process tries again
+            logger.warning(f"Could not import legacy chat history: {str(e)}")
+            return
+    # Chats already present came from an unversioned earlier import or were created since
+    existing = {name for (name,) in db.execute("SELECT name FROM chats")}
+    conversations = {name: messages for name, messages in conversations.items() if name not in existing}
+    with db:
+        db.execute("BEGIN")
+        db.executemany("INSERT INTO chats (name) VALUES (?)", ((name,) for name in conversations))
+        db.executemany(
+            "INSERT INTO messages (chat_name, idx, role, content, id) VALUES (?, ?, ?, ?, ?)",
+            (
+                (chat_name, idx, msg["role"], msg["content"], uuid.uuid4().hex)
+                for chat_name, messages in conversations.items()
+                for idx, msg in enumerate(messages)
+            )
+        )
+        db.execute("PRAGMA user_version = 1")
+    if conversations:
+        logger.info(f"Imported {len(conversations)} conversations from legacy chat history")
+
+
+@st.cache_resource
+def get_db() -> sqlite3.Connection:
+    """Open the shared SQLite connection used for chat persistence"""
+    db = sqlite3.connect(DATA_STORE, isolation_level=None, check_same_thread=False)
+    for pragma in DB_PRAGMAS:
+        db.execute(pragma)
+    db.execute("CREATE TABLE IF NOT EXISTS chats (name TEXT PRIMARY KEY)")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS messages ("
+        "chat_name TEXT NOT NULL REFERENCES chats (name) ON UPDATE CASCADE ON DELETE CASCADE, "
+        "idx INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, id TEXT, "
+        "PRIMARY KEY (chat_name, idx))"
+    )
+    # Stores created before message ids were persisted get the column and an id per row
+    if "id" not in {column for (_, column, *_) in db.execute("PRAGMA table_info(messages)")}:
+        db.execute("ALTER TABLE messages ADD COLUMN id TEXT")
+        db.execute("UPDATE messages SET id = lower(hex(randomblob(16)))")
+    import_legacy_store(db)
+    return db
+
+
+@st.cache_resource
+def load_env() -> bool:
+    """Load environment variables from .env once per process"""
+    from dotenv import load_dotenv
+    return load_dotenv()
+
+
+@st.cache_resource
+def get_groq_client(api_key: str) -> "Groq":
+    """Create the Groq client once and reuse its connection pool across reruns"""
+    # Imported here rather than at module top: groq (httpx, pydantic) loads on the first client build, once per process
+    from groq import Groq
+    return Groq(api_key=api_key)
+
 
 class PhoenixAI:
     """Phoenix AI Chat Application Class"""
@@ -164,14 +345,14 @@ class PhoenixAI:
         """Initialize the Phoenix AI application"""
         self.setup_state()
         self.setup_api_client()
-        self.load_chat_history()
+        self.db = get_db()
+        if "conversations" not in st.session_state:
+            self.load_chat_history()
     
     def setup_state(self):
         """Set up session state variables"""
         if "groq_model" not in st.session_state:
             st.session_state.groq_model = DEFAULT_MODEL
-        if "conversations" not in st.session_state:
-            st.session_state.conversations = {}
         if "current_chat" not in st.session_state:
             st.session_state.current_chat = None
         if "api_error" not in st.session_state:
@@ -180,23 +361,30 @@ class PhoenixAI:
     def setup_api_client(self):
         """Set up the Groq API client"""
         try:
+            load_env()
             api_key = os.getenv("GROQ_API_KEY")
             if not api_key:
                 logger.error("Missing GROQ_API_KEY environment variable")
                 st.session_state.api_error = "Missing API key. Please check your .env file."
                 self.client = None
             else:
-                self.client = Groq(api_key=api_key)
+                self.client = get_groq_client(api_key)
         except Exception as e:
             logger.error(f"Failed to initialize Groq client: {str(e)}")
             st.session_state.api_error = f"API client initialization failed: {str(e)}"
             self.client = None
     
     def load_chat_history(self):
-        """Load conversation history from storage"""
+        """Load conversation history from storage once per session"""
+        if legacy_import_pending(self.db):
+            st.error("Failed to import conversations from the previous chat history store. The import will be retried on the next restart.")
         try:
-            with shelve.open(DATA_STORE) as db:
-                st.session_state.conversations = db.get("conversations", {})
+            conversations = {name: [] for (name,) in self.db.execute("SELECT name FROM chats ORDER BY rowid")}
+            for chat_name, role, content, msg_id in self.db.execute(
+                "SELECT chat_name, role, content, id FROM messages ORDER BY chat_name, idx"
+            ):
+                conversations[chat_name].append(make_message(role, content, msg_id))
+            st.session_state.conversations = conversations
             
             # Set current chat if not set but conversations exist
             if not st.session_state.current_chat and st.session_state.conversations:
@@ -206,21 +394,32 @@ class PhoenixAI:
             st.error("Failed to load previous conversations. Starting with a fresh session.")
             st.session_state.conversations = {}
     
-    def save_chat_history(self):
-        """Save conversation history to storage"""
+    def append_message(self, chat_name: str, msg: Dict):
+        """Persist a message that was just appended to a conversation"""
+        idx = len(st.session_state.conversations[chat_name]) - 1
+        self.execute_persistent(
+            "INSERT INTO messages (chat_name, idx, role, content, id) VALUES (?, ?, ?, ?, ?)",
+            (chat_name, idx, msg["role"], msg["content"], msg["id"])
+        )
+    
+    def execute_persistent(self, sql: str, params: tuple):
+        """Run a write against the chat store, warning the user if it fails"""
         try:
-            with shelve.open(DATA_STORE) as db:
-                db["conversations"] = st.session_state.conversations
+            self.db.execute(sql, params)
         except Exception as e:
             logger.error(f"Failed to save chat history: {str(e)}")
             st.warning("Failed to save this conversation for future sessions.", icon="⚠️")
     
     def create_new_chat(self):
         """Create a new conversation"""
-        new_chat_name = f"Chat {len(st.session_state.conversations) + 1}"
+        # Skip names still in use, e.g. "Chat 2" after "Chat 1" was deleted
+        n = len(st.session_state.conversations) + 1
+        while f"Chat {n}" in st.session_state.conversations:
+            n += 1
+        new_chat_name = f"Chat {n}"
         st.session_state.conversations[new_chat_name] = []
         st.session_state.current_chat = new_chat_name
-        self.save_chat_history()
+        self.execute_persistent("INSERT INTO chats (name) VALUES (?)", (new_chat_name,))
         return new_chat_name
     
     def rename_chat(self, old_name: str, new_name: str):
@@ -228,7 +427,7 @@ class PhoenixAI:
         if new_name and new_name != old_name and new_name not in st.session_state.conversations:
             st.session_state.conversations[new_name] = st.session_state.conversations.pop(old_name)
             st.session_state.current_chat = new_name
-            self.save_chat_history()
+            self.execute_persistent("UPDATE chats SET name = ? WHERE name = ?", (new_name, old_name))
             return True
         return False
     
@@ -238,73 +437,102 @@ class PhoenixAI:
             del st.session_state.conversations[chat_name]
             if st.session_state.current_chat == chat_name:
                 st.session_state.current_chat = next(iter(st.session_state.conversations)) if st.session_state.conversations else None
-            self.save_chat_history()
+            self.execute_persistent("DELETE FROM chats WHERE name = ?", (chat_name,))
             return True
         return False
     
-    def generate_response(self, messages: List[Dict]):
-        """Generate a response using the Groq API"""
+    def generate_response(self, messages: List[Dict]) -> Iterator[str]:
+        """Stream a response from the Groq API, yielding content deltas as they arrive"""
         if not self.client:
-            return "API client not initialized. Please check your API key."
+            yield "API client not initialized. Please check your API key."
+            return
         
         try:
             start_time = time.time()
-            response = self.client.chat.completions.create(
+            stream = self.client.chat.completions.create(
                 model=st.session_state.groq_model,
-                messages=messages
+                messages=[{"role": msg["role"], "content": msg["content"]} for msg in trim_context(messages)],
+                stream=True
             )
+            # Buffer deltas and yield at most every STREAM_FLUSH_INTERVAL so the UI isn't updated per token
+            parts = []
+            buffered = 0
+            last_flush = time.monotonic()
+            for chunk in stream:
+                choices = chunk.choices
+                delta = choices[0].delta.content if choices else None
+                if not delta:
+                    continue
+                parts.append(delta)
+                buffered += len(delta)
+                now = time.monotonic()
+                if now - last_flush >= STREAM_FLUSH_INTERVAL or buffered >= STREAM_FLUSH_CHARS:
+                    yield "".join(parts)
+                    parts.clear()
+                    buffered = 0
+                    last_flush = now
+            if parts:
+                yield "".join(parts)
             end_time = time.time()
             logger.info(f"Response generated in {end_time - start_time:.2f} seconds")
-            return response.choices[0].message.content
         except Exception as e:
             logger.error(f"API error: {str(e)}")
-            return f"Sorry, I encountered an error: {str(e)}"
+            yield f"Sorry, I encountered an error: {str(e)}"
     
+    @st.fragment
     def render_sidebar(self):
-        """Render the application sidebar"""
-        with st.sidebar:
-            st.markdown("## Phoenix AI")
-            st.markdown("---")
-            
-            # Model selection
-            st.selectbox(
-                "Model",
-                options=list(MODELS.keys()),
-                index=list(MODELS.values()).index(st.session_state.groq_model) if st.session_state.groq_model in MODELS.values() else 0,
-                key="model_selector",
-                on_change=self.update_model
+        """Render the application sidebar; reruns on its own unless the main area needs updating"""
+        st.markdown("## Phoenix AI")
+        st.markdown("---")
+        
+        # Model selection
+        st.selectbox(
+            "Model",
+            options=MODEL_NAMES,
+            index=MODEL_NAME_TO_IDX.get(MODEL_ID_TO_NAME.get(st.session_state.groq_model), 0),
+            key="model_selector",
+            on_change=self.update_model
+        )
+        
+        # New chat button
+        if st.button("+ New Conversation", use_container_width=True, type="primary"):
+            self.create_new_chat()
+            st.rerun()
+        
+        st.markdown("### Your Conversations")
+        st.markdown("---")
+        
+        # Chat history list
+        if not st.session_state.conversations:
+            st.info("No conversations yet. Start one by sending a message!")
+        else:
+            # One radio and one selectbox cover every conversation, however many there are
+            chat_names = tuple(st.session_state.conversations)
+            selected = st.radio(
+                "Conversations",
+                options=chat_names,
+                index=chat_names.index(st.session_state.current_chat) if st.session_state.current_chat in chat_names else None,
+                label_visibility="collapsed"
             )
+            if selected and selected != st.session_state.current_chat:
+                st.session_state.current_chat = selected
+                st.rerun()
             
-            # New chat button
-            if st.button("+ New Conversation", use_container_width=True, type="primary"):
-                self.create_new_chat()
-            
-            st.markdown("### Your Conversations")
-            st.markdown("---")
-            
-            # Chat history list
-            if not st.session_state.conversations:
-                st.info("No conversations yet. Start one by sending a message!")
-            
-            for chat_name in list(st.session_state.conversations.keys()):
-                col1, col2 = st.columns([4, 1])
-                with col1:
-                    if st.button(
-                        chat_name,
-                        key=f"btn_{chat_name}",
-                        type="primary" if chat_name == st.session_state.current_chat else "secondary",
-                        use_container_width=True
-                    ):
-                        st.session_state.current_chat = chat_name
-                
-                with col2:
-                    if st.button("×", key=f"del_{chat_name}"):
-                        if st.session_state.current_chat == chat_name:
-                            self.delete_chat(chat_name)
-                            st.rerun()
-            
-            # Footer
-            st.markdown("""<div class="footer">Phoenix AI v1.2.0</div>""", unsafe_allow_html=True)
+            # Deletion only happens on an explicit submit, not on picking an entry
+            with st.form("delete_chat_form", border=False):
+                to_delete = st.selectbox(
+                    "Delete chat",
+                    options=chat_names,
+                    index=None,
+                    placeholder="Delete chat…",
+                    label_visibility="collapsed"
+                )
+                if st.form_submit_button("Delete", width="stretch") and to_delete:
+                    self.delete_chat(to_delete)
+                    st.rerun()
+        
+        # Footer
+        st.markdown("""<div class="footer">Phoenix AI v1.2.0</div>""", unsafe_allow_html=True)
     
     def update_model(self):
         """Update the model based on selection"""
@@ -320,6 +548,11 @@ class PhoenixAI:
         if st.session_state.api_error:
             st.error(st.session_state.api_error)
         
+        self.render_chat()
+    
+    @st.fragment
+    def render_chat(self):
+        """Render the conversation and handle new messages without rerunning the sidebar"""
         # Chat container with fixed height
         chat_container = st.container(height=680)
         input_container = st.container()
@@ -327,63 +560,55 @@ class PhoenixAI:
         # Display messages if conversation exists
         if st.session_state.current_chat:
             messages = st.session_state.conversations[st.session_state.current_chat]
-            with chat_container:
-                for msg in messages:
-                    with st.chat_message(msg["role"]):
-                        st.markdown(msg["content"])
+            if messages:
+                # Replay the whole history as a single element instead of one per message
+                chat_container.html("".join(message_html(msg) for msg in messages))
         
         # Chat input
         with input_container:
             if prompt := st.chat_input("Type your message here..."):
-                if not st.session_state.current_chat:
+                is_new_chat = not st.session_state.current_chat
+                if is_new_chat:
                     self.create_new_chat()
                 
                 # Add user message
                 messages = st.session_state.conversations[st.session_state.current_chat]
-                messages.append({"role": "user", "content": prompt})
+                user_msg = make_message("user", prompt)
+                messages.append(user_msg)
+                self.append_message(st.session_state.current_chat, user_msg)
                 
                 # Display user message
-                with chat_container.chat_message("user"):
-                    st.markdown(prompt)
+                chat_container.html(message_html(user_msg))
                 
                 # Generate and display assistant response
-                with chat_container.chat_message("assistant"):
-                    with st.spinner("Thinking..."):
-                        full_response = self.generate_response(messages)
-                        st.markdown(full_response)
+                placeholder = chat_container.chat_message("assistant").empty()
+                full_response = ""
+                for chunk in self.generate_response(messages):
+                    full_response += chunk
+                    placeholder.markdown(full_response + "▌")
+                placeholder.markdown(full_response)
                 
                 # Save conversation
-                messages.append({"role": "assistant", "content": full_response})
-                st.session_state.conversations[st.session_state.current_chat] = messages
-                self.save_chat_history()
+                assistant_msg = make_message("assistant", full_response)
+                messages.append(assistant_msg)
+                self.append_message(st.session_state.current_chat, assistant_msg)
+                
+                # The sidebar only learns about a chat created from here on a full rerun
+                if is_new_chat:
+                    st.rerun()
+        
+        # Add auto-scroll and keyboard shortcut
+        st.html(CUSTOM_JS, unsafe_allow_javascript=True)
     
     def run(self):
         """Run the Phoenix AI application"""
         # Apply custom CSS
-        st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+        st.markdown(COMPILED_CSS, unsafe_allow_html=True)
         
         # Render the sidebar and main interface
-        self.render_sidebar()
+        with st.sidebar:
+            self.render_sidebar()
         self.render_main_interface()
-        
-        # Add auto-scroll functionality
-        st.components.v1.html("""
-        <script>
-        const container = window.parent.document.querySelector('[data-testid="stAppViewContainer"]');
-        container.scrollTop = container.scrollHeight;
-        
-        // Add keyboard shortcut (Ctrl+Enter) for sending messages
-        document.addEventListener('keydown', function(e) {
-            if (e.ctrlKey && e.key === 'Enter') {
-                const chatInput = window.parent.document.querySelector('.stChatInput input');
-                const sendButton = window.parent.document.querySelector('.stChatInput button');
-                if (chatInput && chatInput.value.trim() && sendButton) {
-                    sendButton.click();
-                }
-            }
-        });
-        </script>
-        """)
 
 
 # Run the application